@@ -1,7 +1,17 @@
+import argparse
+import asyncio
+import base64
 import email
+import functools
+import hashlib
 import imaplib
+import itertools
+import json
+import quopri
 import re
+import sqlite3
 import time
+from collections import defaultdict
 from email.header import decode_header
 from email.utils import parsedate_to_datetime
 import datetime
@@ -18,10 +28,66 @@ from config import GMAIL_ADDRESS, GMAIL_APP_PASSWORD, GEMINI_API_KEY, SHEET_ID
 # 1️⃣ Gmail IMAP Configuration
 IMAP_SERVER = "imap.gmail.com"
 MAILBOX = "inbox"
+# Gmail's IMAP SUBJECT search matches whole words, not substrings, so inflected forms are listed too
+JOB_KEYWORDS = (
+    "job", "jobs", "application", "applications", "career", "careers", "hiring",
+    "interview", "interviews", "interviewing", "position", "positions", "offer", "offers",
+)
+FETCH_BATCH_SIZE = 100  # Message IDs per FETCH command (avoids "request too large" errors)
+HEADER_FIELDS = "BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE)]"
+STATE_FILE = "imap_state.json"  # Highest UID already processed, so later runs only search newer mail
+IDLE_TIMEOUT = 29 * 60  # Re-issue IDLE before servers drop it (RFC 2177 suggests < 30 minutes)
+WATCH_RETRY_DELAY = 60  # Seconds to wait after a failed scan in --watch mode, doubled on each further failure
+WATCH_MAX_RETRY_DELAY = 15 * 60
+
+_SENDER_RE = re.compile(r"[\w.\-]+@[\w.\-]+")
+_HEADER_END_RE = re.compile(rb"\r?\n\r?\n")
+# Start of a quoted reply chain or signature: "On ... wrote:", "-- ", "-----Original Message-----"
+_QUOTED_TAIL_RE = re.compile(r"\r?\n(?:On [^\n]+ wrote:|-- |-{5}\s*Original Message\s*-{5})[ \t]*\r?\n")
+
+# Tokens of an IMAP FETCH response; BODY[...] section specs are kept as part of the atom
+_IMAP_TOKEN_RE = re.compile(
+    rb'\s*(?:(?P<open>\()|(?P<close>\))|"(?P<quoted>(?:[^"\\]|\\.)*)"|(?P<literal>\{\d+\})'
+    rb'|(?P<atom>[^\s()"{\[\]]+(?:\[[^\]]*\])?(?:<[\d.]+>)?))'
+)
 
 # 2️⃣ Gemini AI Configuration
 genai.configure(api_key=GEMINI_API_KEY)
 model = genai.GenerativeModel("models/gemini-1.5-flash")
+GEMINI_CONCURRENCY = 5  # Max in-flight Gemini requests (keeps us under the QPS limit)
+GEMINI_REQUESTS_PER_MINUTE = 60  # Gemini API request quota for the model
+
+MAX_BODY_CHARS = 4096  # ~1k tokens; Gemini only needs the start of an email and input tokens drive latency
+GEMINI_BATCH_SIZE = 10  # Emails packed into a single Gemini prompt
+GEMINI_BATCH_CHARS = 50_000  # Max body characters per prompt, to stay well inside the context window
+
+# Gemini replies with JSON matching this schema, so no free-text parsing is needed.
+# 'idx' maps each result back to the email it came from within a batch.
+JOB_DATA_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "idx": {"type": "integer"},
+            "job_title": {"type": "string"},
+            "company_name": {"type": "string"},
+            "application_status": {
+                "type": "string",
+                "enum": ["Submitted", "Interview", "Offer", "Rejected", "Other"],
+            },
+        },
+        "required": ["idx", "job_title", "company_name", "application_status"],
+    },
+}
+JOB_DATA_CONFIG = genai.types.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=JOB_DATA_SCHEMA,
+)
+
+# Gemini results cached by email body hash, so repeated emails skip the API call
+GEMINI_CACHE_FILE = "gemini_cache.sqlite3"
+gemini_cache = sqlite3.connect(GEMINI_CACHE_FILE)
+gemini_cache.execute("CREATE TABLE IF NOT EXISTS responses (hash BLOB PRIMARY KEY, json TEXT)")
 
 # 3️⃣ Google Sheets Configuration
 # Note: Ensure your 'credentials.json' is for a service account.
@@ -29,15 +95,48 @@ gc = gspread.service_account(filename="credentials.json")
 spreadsheet = gc.open_by_key(SHEET_ID)
 sheet = spreadsheet.sheet1
 
+# 4️⃣ Pipeline Configuration
+PARSE_QUEUE_SIZE = 32  # Fetched emails waiting for Gemini
+WRITE_QUEUE_SIZE = 64  # Gemini results waiting to be written to the sheet
+SHEETS_FLUSH_ROWS = 25  # Queued sheet writes per batch_update/append_rows flush
+
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Helper Functions
 # ──────────────────────────────────────────────────────────────────────────────
 
-def build_recent_unseen_query(days=3):
-    """Builds a Gmail IMAP query for unseen emails from the last N days."""
+def build_recent_unseen_query(days=3, keywords=JOB_KEYWORDS, since_uid=None):
+    """Builds a Gmail IMAP query for unseen job-related emails from the last N days.
+
+    When since_uid is given, only emails with a higher UID are matched.
+    """
     since_date = (datetime.date.today() - datetime.timedelta(days=days)).strftime("%d-%b-%Y")
-    return f'(UNSEEN SINCE {since_date})'
+
+    # IMAP OR takes exactly two keys, so nest them: (OR SUBJECT "a" (OR SUBJECT "b" SUBJECT "c"))
+    subject_filter = f'SUBJECT "{keywords[-1]}"'
+    for keyword in reversed(keywords[:-1]):
+        subject_filter = f'(OR SUBJECT "{keyword}" {subject_filter})'
+
+    uid_filter = f"UID {since_uid + 1}:* " if since_uid else ""
+    return f'({uid_filter}UNSEEN SINCE {since_date} {subject_filter})'
+
+
+def load_last_uid(uidvalidity):
+    """Returns the last processed UID, or None if unknown or the mailbox's UIDs were reset."""
+    try:
+        with open(STATE_FILE) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("uidvalidity") != uidvalidity:
+        return None
+    return state.get("last_uid")
+
+
+def save_last_uid(uidvalidity, last_uid):
+    """Remembers the highest processed UID for the next run."""
+    with open(STATE_FILE, "w") as f:
+        json.dump({"uidvalidity": uidvalidity, "last_uid": last_uid}, f)
 
 
 def connect_to_gmail():
@@ -52,156 +151,677 @@ def connect_to_gmail():
         return None
 
 
+def wait_for_new_mail(mail, timeout=IDLE_TIMEOUT):
+    """Blocks in IMAP IDLE until the server reports new mail or the timeout passes.
+
+    Returns True when new mail arrived. Returns False on timeout or if the
+    connection dropped; the connection is unusable then and must be replaced.
+    """
+    tag = b"IDLE1"
+    mail.send(tag + b" IDLE\r\n")
+    if not mail.readline().startswith(b"+"):
+        return False
+
+    # Read with a socket timeout rather than select(): lines the server sent together
+    # with "+ idling" are already buffered in mail.file, where select() can't see them.
+    deadline = time.monotonic() + timeout
+    try:
+        while (remaining := deadline - time.monotonic()) > 0:
+            mail.sock.settimeout(remaining)
+            line = mail.readline()
+            if not line:
+                return False
+            if line.endswith(b"EXISTS\r\n"):
+                break
+        else:
+            return False
+
+        mail.send(b"DONE\r\n")
+        while (line := mail.readline()) and not line.startswith(tag):
+            pass
+        return bool(line)
+    except TimeoutError:
+        return False
+    finally:
+        mail.sock.settimeout(None)
+
+
+def close_quietly(mail):
+    """Logs out of an IMAP connection, ignoring errors from an already-broken one."""
+    try:
+        mail.logout()
+    except Exception:
+        pass
+
+
+def quick_headers(raw_email):
+    """Reads header fields straight from raw bytes, without building an email.Message.
+
+    Returns a dict of lowercased header names to values; only the first
+    occurrence of each header is kept and folded lines are unfolded.
+    """
+    header_blob = _HEADER_END_RE.split(raw_email, 1)[0]
+    headers = {}
+    current = None
+    for line in header_blob.splitlines():
+        if line[:1] in (b" ", b"\t"):
+            if current:
+                headers[current] += " " + line.strip().decode(errors="replace")
+            continue
+        if b":" not in line:
+            current = None
+            continue
+        name, value = line.split(b":", 1)
+        name = name.strip().lower().decode(errors="replace")
+        current = name if name not in headers else None
+        if current:
+            headers[name] = value.strip().decode(errors="replace")
+    return headers
+
+
+@functools.lru_cache(maxsize=1024)
+def decode_subject(raw_subject):
+    """Decodes RFC 2047 encoded-words in a Subject header.
+
+    Subjects without encoded-words (the common case) are returned as-is
+    without running the decoder; repeated subjects are served from the cache.
+    """
+    if "=?" not in raw_subject:
+        return raw_subject
+    parts = []
+    for part, charset in decode_header(raw_subject):
+        if isinstance(part, bytes):
+            try:
+                part = part.decode(charset or "utf-8", errors="ignore")
+            except LookupError:
+                part = part.decode(errors="ignore")
+        parts.append(part)
+    return "".join(parts)
+
+
 def get_email_body(msg):
-    """Extracts the plaintext body from an email message."""
-    if msg.is_multipart():
-        for part in msg.walk():
-            if part.get_content_type() == "text/plain":
-                return part.get_payload(decode=True).decode(errors="ignore")
-    else:
-        return msg.get_payload(decode=True).decode(errors="ignore")
+    """Extracts the plaintext body from an email message.
+
+    Only the first inline text/plain part is decoded; multipart containers and
+    attachments are skipped without decoding their payloads.
+    """
+    for part in msg.walk():
+        if part.get_content_maintype() == "multipart" or part.get_content_disposition() == "attachment":
+            continue
+        # A single-part message is read whatever its type
+        if part.get_content_type() == "text/plain" or not msg.is_multipart():
+            payload = part.get_payload(decode=True) or b""
+            try:
+                return payload.decode(part.get_content_charset() or "utf-8", errors="ignore")
+            except LookupError:
+                return payload.decode(errors="ignore")
     return ""
 
 
-def extract_job_data_with_gemini(email_body):
-    """Uses Gemini to extract structured job information from an email body."""
-    prompt = f"""
-    You are an intelligent assistant reading an email about a job application.
-    Extract the following details:
-    - Job Title
-    - Company Name
-    - Application Status (e.g., Submitted, Interview, Offer, Rejected, Other)
+def trim_email_body(body):
+    """Drops quoted replies and signatures, then keeps only the first MAX_BODY_CHARS."""
+    return _QUOTED_TAIL_RE.split(body, 1)[0][:MAX_BODY_CHARS]
+
+
+def _tokenize_fetch_response(segments):
+    """Yields (kind, value) tokens for a FETCH response; literals are yielded as strings."""
+    for text, literal in segments:
+        pos = 0
+        while match := _IMAP_TOKEN_RE.match(text, pos):
+            pos = match.end()
+            if match.lastgroup != "literal":
+                yield match.lastgroup, match.group(match.lastgroup)
+        if literal is not None:
+            yield "string", literal
+
+
+def _parse_fetch_tokens(tokens):
+    """Turns FETCH response tokens into nested lists (NIL becomes None)."""
+    stack = [[]]
+    for kind, value in tokens:
+        if kind == "open":
+            stack.append([])
+        elif kind == "close":
+            done = stack.pop()
+            stack[-1].append(done)
+        elif kind == "quoted":
+            stack[-1].append(re.sub(rb'\\(.)', rb"\1", value))
+        elif kind == "atom" and value.upper() == b"NIL":
+            stack[-1].append(None)
+        else:
+            stack[-1].append(value)
+    return stack[0]
+
+
+def parse_fetch_response(msg_data):
+    """Parses imaplib FETCH data into (email_id, {ITEM NAME: value}) pairs."""
+    # imaplib returns (line, literal) tuples for each literal in a response,
+    # followed by the rest of the response line as plain bytes.
+    segments = []
+    for item in msg_data:
+        if isinstance(item, tuple):
+            segments.append(item)
+            continue
+        if item is None:
+            continue
+        segments.append((item, None))
+        try:
+            email_id, attributes = _parse_fetch_tokens(_tokenize_fetch_response(segments))[:2]
+            yield email_id, {key.upper(): value for key, value in zip(attributes[::2], attributes[1::2])}
+        except (IndexError, TypeError, ValueError, AttributeError):
+            print(f"⚠️ Skipping unparseable FETCH response: {segments[0][0][:80]!r}")
+        segments = []
+
+
+def fetch_in_batches(mail, email_ids, message_parts, batch_size=FETCH_BATCH_SIZE):
+    """Runs one UID FETCH per batch of UIDs, yielding (uid, {ITEM NAME: value})."""
+    for start in range(0, len(email_ids), batch_size):
+        batch = email_ids[start:start + batch_size]
+        try:
+            # One FETCH per batch instead of one round trip per message
+            res, msg_data = mail.uid("fetch", b",".join(batch), message_parts)
+        except Exception as e:
+            print(f"❗️ An error occurred while fetching emails: {e}")
+            continue
+        if res != "OK":
+            continue
+        for _, items in parse_fetch_response(msg_data):
+            if b"UID" in items:  # Skip unsolicited FETCH responses (e.g. FLAGS updates)
+                yield items[b"UID"], items
+
+
+def find_text_part(structure, section=""):
+    """Finds (section, encoding, charset) of the first text/plain part in a BODYSTRUCTURE."""
+    if isinstance(structure[0], list):
+        # Multipart: child parts come first, followed by the subtype and extension data
+        children = itertools.takewhile(lambda part: isinstance(part, list), structure)
+        for i, child in enumerate(children, start=1):
+            found = find_text_part(child, f"{section}.{i}" if section else str(i))
+            if found:
+                return found
+        return None
+
+    # A single-part message is read whatever its type, like get_email_body() does
+    content_type = (structure[0] or b"").lower(), (structure[1] or b"").lower()
+    if section and content_type != (b"text", b"plain"):
+        return None
+    disposition = structure[9] if len(structure) > 9 else None
+    if section and isinstance(disposition, list) and (disposition[0] or b"").lower() == b"attachment":
+        return None
+
+    params = structure[2] or []
+    charset = next((value for key, value in zip(params[::2], params[1::2]) if key.lower() == b"charset"), None)
+    encoding = structure[5] or b"7bit"
+    return section or "1", encoding.decode().lower(), charset.decode() if charset else "utf-8"
+
+
+def decode_part(data, encoding, charset):
+    """Decodes a fetched MIME part using its transfer encoding and charset."""
+    if encoding == "base64":
+        data = base64.b64decode(data)
+    elif encoding == "quoted-printable":
+        data = quopri.decodestring(data)
+    try:
+        return data.decode(charset, errors="ignore")
+    except LookupError:
+        return data.decode(errors="ignore")
+
+
+def fetch_emails(mail, email_ids):
+    """Fetches headers and plaintext body of each email, yielding (email_id, headers, body).
+
+    Only the header fields we use and the BODYSTRUCTURE are fetched first; the
+    text/plain part is then fetched on its own, so HTML alternatives and
+    attachments are never downloaded. Emails whose structure or text part
+    can't be fetched or decoded fall back to a full fetch.
+    """
+    headers = {}
+    text_parts = {}
+    ids_by_section = defaultdict(list)
+    needs_full_fetch = []
+
+    # Stage 1: headers + structure
+    for email_id, items in fetch_in_batches(mail, email_ids, f"({HEADER_FIELDS} BODYSTRUCTURE)"):
+        if b"BODYSTRUCTURE" not in items:
+            continue  # Unsolicited FETCH (e.g. a FLAGS update)
+        try:
+            raw_headers = next(value for key, value in items.items() if key.startswith(b"BODY[HEADER"))
+            part = find_text_part(items[b"BODYSTRUCTURE"])
+        except Exception:
+            needs_full_fetch.append(email_id)
+            continue
+
+        headers[email_id] = quick_headers(raw_headers or b"")
+        if not part:
+            yield email_id, headers[email_id], ""
+            continue
+        section, encoding, charset = part
+        text_parts[email_id] = (encoding, charset)
+        ids_by_section[section].append(email_id)
+
+    # Stage 2: text/plain parts, one bulk FETCH per section number
+    for section, ids in ids_by_section.items():
+        fetched = set()
+        for email_id, items in fetch_in_batches(mail, ids, f"(BODY.PEEK[{section}])"):
+            data = next((value for key, value in items.items() if key.startswith(b"BODY[")), False)
+            if data is False or email_id not in text_parts or email_id in fetched:
+                continue
+            fetched.add(email_id)
+            try:
+                body = decode_part(data or b"", *text_parts[email_id])
+            except Exception as e:
+                print(f"⚠️ Could not decode email {email_id.decode()} ({e}); fetching it in full.")
+                needs_full_fetch.append(email_id)
+                continue
+            yield email_id, headers[email_id], trim_email_body(body)
+
+        missing = [email_id for email_id in ids if email_id not in fetched]
+        if missing:
+            print(f"⚠️ No text part returned for {len(missing)} emails; fetching them in full.")
+            needs_full_fetch.extend(missing)
+
+    # Fallback: full message for anything we couldn't make sense of
+    fetched = set()
+    for email_id, items in fetch_in_batches(mail, needs_full_fetch, "(BODY.PEEK[])"):
+        if b"BODY[]" not in items or email_id in fetched:
+            continue
+        fetched.add(email_id)
+        try:
+            raw_email = items[b"BODY[]"] or b""
+            body = get_email_body(email.message_from_bytes(raw_email))
+            yield email_id, quick_headers(raw_email), trim_email_body(body)
+        except Exception as e:
+            print(f"❗️ An error occurred while decoding an email: {e}")
+
+    missing = len(set(needs_full_fetch) - fetched)
+    if missing:
+        print(f"❗️ Could not fetch {missing} emails.")
+
+
+class RateLimiter:
+    """Token bucket for asyncio that never allows more than `rate` calls in any `period` seconds.
+
+    Up to `burst` calls may go through at once. The bucket holds at most `burst`
+    tokens and refills at (rate - burst) per period, so a full burst plus a
+    period of refill stays within `rate`.
+    """
+
+    def __init__(self, rate, period=60.0, burst=1):
+        self.burst = min(burst, rate - 1) if rate > 1 else 0
+        self.refill_per_second = (rate - self.burst) / period
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        """Waits until a call is allowed."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+        # Take the token now, even if it goes negative: the caller then sleeps until its
+        # reserved token has refilled, so concurrent callers queue up in order.
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.refill_per_second)
+
+
+gemini_rate_limiter = RateLimiter(GEMINI_REQUESTS_PER_MINUTE, burst=GEMINI_CONCURRENCY)
+
+
+def body_hash(email_body):
+    """Hashes an email body with whitespace normalised (BLAKE2b: fast, no crypto needed)."""
+    return hashlib.blake2b(" ".join(email_body.split()).encode(), digest_size=16).digest()
 
-    Respond only with the following format:
-    Job Title: [The Job Title]
-    Company Name: [The Company Name]
-    Application Status: [The Application Status]
+
+def get_cached_job_data(key):
+    """Returns the cached Gemini result for a body hash, or None on a cache miss."""
+    row = gemini_cache.execute("SELECT json FROM responses WHERE hash = ?", (key,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+async def extract_job_data_with_gemini(email_bodies, semaphore, keys=None):
+    """Uses Gemini to extract structured job information from a batch of email bodies.
+
+    Returns one result per body, in order: a dict ({} if Gemini's answer for it
+    was empty), or None if the request failed or Gemini left that email out of
+    its reply, in which case it should be retried.
+    Bodies seen before are answered from the cache and not sent to Gemini.
+    Pass keys when the body hashes are already known.
+    """
+    keys = keys or [body_hash(body) for body in email_bodies]
+    results = [get_cached_job_data(key) for key in keys]
+    misses = [i for i, result in enumerate(results) if result is None]
+    if not misses:
+        return results
+
+    prompt = """
+    You are an intelligent assistant reading emails about job applications.
+    For each email below, extract the Job Title, the Company Name and the
+    Application Status, and set idx to the number in the email's [brackets].
     """
+    emails = "\n\n".join(f"### EMAIL [{n}]\n{email_bodies[i]}" for n, i in enumerate(misses))
     try:
-        response = model.generate_content(prompt + "\n\nEMAIL BODY:\n" + email_body)
-        return response.text.strip()
+        await gemini_rate_limiter.acquire()
+        async with semaphore:
+            response = await model.generate_content_async(
+                prompt + "\n\nEMAILS:\n" + emails,
+                generation_config=JOB_DATA_CONFIG,
+            )
+        items = json.loads(response.text)
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            raise ValueError(f"unexpected response: {response.text[:80]!r}")
     except Exception as e:
         print(f"Error calling Gemini API: {e}")
-        return ""
-
-
-def parse_gemini_output(output):
-    """Parses the key-value response from Gemini into a dictionary."""
-    data = {}
-    for line in output.splitlines():
-        if ":" in line:
-            key, val = line.split(":", 1)
-            # Normalize key: 'Job Title' -> 'job_title'
-            normalized_key = key.strip().lower().replace(" ", "_")
-            data[normalized_key] = val.strip()
-    return data
-
-
-def find_existing_row_index(company, title, sender):
-    """Finds a row index matching Company, Job Title, and Sender."""
-    # This is a simple implementation. For very large sheets, consider a more
-    # efficient lookup method or a local cache.
-    records = sheet.get_all_records()
+        return results
+
+    answered = {}
+    for item in items:
+        idx = item.pop("idx", None)
+        if isinstance(idx, int) and 0 <= idx < len(misses):
+            answered[misses[idx]] = item
+            gemini_cache.execute(
+                "INSERT OR REPLACE INTO responses (hash, json) VALUES (?, ?)", (keys[misses[idx]], json.dumps(item))
+            )
+    gemini_cache.commit()
+
+    skipped = len(misses) - len(answered)
+    if skipped:
+        print(f"⚠️ Gemini left {skipped} emails out of its reply; they will be retried.")
+    return [answered.get(i) if result is None else result for i, result in enumerate(results)]
+
+
+def flush_sheet_writes(to_update, to_append):
+    """Writes queued row updates ({row number: row}) and new rows to the sheet in (at most) two API calls."""
+    # RAW, not USER_ENTERED: values come from email text and must never be evaluated as formulas
+    if to_update:
+        ranges = [{"range": f"A{row}:E{row}", "values": [row_data]} for row, row_data in to_update.items()]
+        sheet.batch_update(ranges, value_input_option="RAW")
+    if to_append:
+        sheet.append_rows(to_append, value_input_option="RAW")
+
+
+def row_key(company, title, sender):
+    """Builds the case-insensitive (Company, Job Title, Sender) key used to match rows."""
+    return company.lower(), title.lower(), sender.lower()
+
+
+def build_row_index(records):
+    """Builds a (company, title, sender) -> row number lookup from sheet records."""
+    row_index = {}
     for i, record in enumerate(records, start=2):  # start=2 for 1-based index + header
-        if (record.get("Company Name", "").lower() == company.lower() and
-                record.get("Job Title", "").lower() == title.lower() and
-                record.get("Sender Email", "").lower() == sender.lower()):
-            return i
-    return None
+        key = row_key(str(record.get("Company Name", "")),
+                      str(record.get("Job Title", "")),
+                      str(record.get("Sender Email", "")))
+        row_index.setdefault(key, i)  # Keep the first match, like a top-down scan
+    return row_index
 
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Main Logic
 # ──────────────────────────────────────────────────────────────────────────────
 
-def scan_and_process_emails(days=3):
-    """Scans for unread job-related emails and updates the Google Sheet."""
-    mail = connect_to_gmail()
-    if not mail:
-        return
+async def fetcher(mail, email_ids, q_parse):
+    """Pipeline stage 1: fetches emails from Gmail and queues them for analysis."""
+    emails = fetch_emails(mail, email_ids)
+    try:
+        # imaplib is blocking, so each fetch step runs in a worker thread
+        while (item := await asyncio.to_thread(next, emails, None)) is not None:
+            await q_parse.put(item)
+    finally:
+        await asyncio.to_thread(mail.logout)
+        await q_parse.put(None)
 
-    query = build_recent_unseen_query(days)
-    status, data = mail.search(None, query)
 
-    if status != "OK" or not data[0]:
-        print("✅ No new unread job-related emails found.")
-        return
+async def analyze_batch(batch, groups, answered, semaphore, q_write):
+    """Sends one batch of emails to Gemini and queues the results for writing.
 
-    email_ids = data[0].split()
-    print(f"📨 Found {len(email_ids)} unread emails to process from the last {days} days.")
+    Each result is fanned out to every email in its group (same body hash).
+    """
+    keys = [key for key, _ in batch]
+    results = await extract_job_data_with_gemini([body for _, (_, _, _, body, _) in batch], semaphore, keys)
+    for key, job_data in zip(keys, results):
+        if job_data is not None:  # Failed requests aren't reused, so later duplicates retry
+            answered[key] = job_data
+        for email_info in groups.pop(key):
+            await q_write.put((email_info, job_data))
 
-    for email_id in email_ids:
-        try:
-            # Fetch email without marking it as read (using BODY.PEEK)
-            res, msg_data = mail.fetch(email_id, "(BODY.PEEK[])")
-            if res != "OK":
-                continue
 
-            raw_email = msg_data[0][1]
-            msg = email.message_from_bytes(raw_email)
+async def analyzer(q_parse, q_write, semaphore, done):
+    """Pipeline stage 2: decodes emails and sends them to Gemini in batches.
+
+    Emails with the same body share a single Gemini call. UIDs of emails that
+    are deliberately skipped are added to done.
+    """
+    tasks = []
+    batch, batch_chars = [], 0
+    groups = {}  # body hash -> emails waiting on a Gemini call for that body
+    answered = {}  # body hash -> Gemini result already returned in this run
 
+    while (item := await q_parse.get()) is not None:
+        email_id, headers, body = item
+        try:
             # Decode subject and sender
-            subject_header = decode_header(msg.get("Subject", "No Subject"))[0]
-            subject = subject_header[0].decode() if isinstance(subject_header[0], bytes) else subject_header[0]
+            subject = decode_subject(headers.get("subject", "No Subject"))
 
-            sender = msg.get("From", "")
-            sender_email_match = re.search(r"[\w\.-]+@[\w\.-]+", sender)
+            sender = headers.get("from", "")
+            sender_email_match = _SENDER_RE.search(sender)
             sender_email = sender_email_match.group(0) if sender_email_match else ""
 
-            # Basic keyword filter to identify job-related emails
-            keywords = ["job", "application", "career", "hiring", "interview", "position", "offer"]
-            if not any(keyword in subject.lower() for keyword in keywords):
-                continue
-
-            body = get_email_body(msg)
             if not body.strip():
                 print(f"⚠️ Skipping email with empty body. Subject: {subject}")
+                done.add(email_id)
                 continue
 
+        except Exception as e:
+            print(f"❗️ An error occurred while reading an email: {e}")
+            continue
+
+        email_info = (email_id, subject, sender_email, body, headers)
+        key = body_hash(body)
+        if key in answered:
+            await q_write.put((email_info, answered[key]))
+            continue
+        if key in groups:
+            groups[key].append(email_info)
+            continue
+        groups[key] = [email_info]
+
+        # Start a Gemini request as soon as a batch is full; batches run concurrently
+        if batch and batch_chars + len(body) > GEMINI_BATCH_CHARS:
+            tasks.append(asyncio.create_task(analyze_batch(batch, groups, answered, semaphore, q_write)))
+            batch, batch_chars = [], 0
+        batch.append((key, email_info))
+        batch_chars += len(body)
+        if len(batch) >= GEMINI_BATCH_SIZE:
+            tasks.append(asyncio.create_task(analyze_batch(batch, groups, answered, semaphore, q_write)))
+            batch, batch_chars = [], 0
+
+    if batch:
+        tasks.append(asyncio.create_task(analyze_batch(batch, groups, answered, semaphore, q_write)))
+    await asyncio.gather(*tasks)
+    await q_write.put(None)
+
+
+async def writer(q_write, done):
+    """Pipeline stage 3: turns Gemini results into rows and writes them to the sheet in batches.
+
+    UIDs of emails that were written or deliberately skipped are added to done.
+    """
+    # Load the sheet once and index it, instead of re-reading it for every email
+    records = await asyncio.to_thread(sheet.get_all_records)
+    row_index = build_row_index(records)
+    first_new_row = next_row = len(records) + 2
+
+    # Collect sheet writes locally and flush them every SHEETS_FLUSH_ROWS rows
+    to_update = {}
+    to_append = []
+    updated = added = 0
+
+    # Gemini batches finish in any order, so keep the newest email (highest UID) per row,
+    # like processing emails in ascending order would
+    latest_uid = {}
+
+    while (item := await q_write.get()) is not None:
+        (email_id, subject, sender_email, body, headers), job_data = item
+        try:
             print(f"\nProcessing Email | From: {sender_email} | Subject: {subject}")
 
-            # Extract data using Gemini
-            gemini_output = extract_job_data_with_gemini(body)
-            if not gemini_output:
+            if job_data is None:
+                print("⚠️ Gemini request failed; the email will be retried on the next run.")
+                continue
+            if not job_data:
+                done.add(email_id)
                 continue
 
-            print(f"🔍 Gemini Output:\n{gemini_output}")
-            parsed_data = parse_gemini_output(gemini_output)
+            print(f"🔍 Gemini Output: {job_data}")
 
-            company = parsed_data.get("company_name", "")
-            title = parsed_data.get("job_title", "")
-            app_status = parsed_data.get("application_status", "Other")
+            company = job_data.get("company_name", "")
+            title = job_data.get("job_title", "")
+            app_status = job_data.get("application_status", "Other")
 
-            # Get the email's received date
-            date_tuple = parsedate_to_datetime(msg.get("Date"))
-            received_date = date_tuple.strftime("%Y-%m-%d")
+            # Get the email's received date, falling back to today if the Date header is missing or malformed
+            try:
+                received_date = parsedate_to_datetime(headers.get("date")).strftime("%Y-%m-%d")
+            except (TypeError, ValueError):
+                print("⚠️ Missing or invalid Date header; using today's date.")
+                received_date = datetime.date.today().strftime("%Y-%m-%d")
 
             # Skip if essential information is missing
             if not company or not title:
                 print("⚠️ Skipping due to missing Company or Job Title.")
+                done.add(email_id)
                 continue
 
             # Prepare row for Google Sheet
             row_data = [company, title, received_date, sender_email, app_status]
 
-            existing_row_index = find_existing_row_index(company, title, sender_email)
-
-            if existing_row_index:
-                sheet.update(f"A{existing_row_index}:E{existing_row_index}", [row_data])
+            key = row_key(company, title, sender_email)
+            if latest_uid.get(key, -1) > int(email_id):
+                print(f"⏩ Keeping newer email already recorded for {title} at {company}")
+                done.add(email_id)
+                continue
+            latest_uid[key] = int(email_id)
+            existing_row_index = row_index.get(key)
+
+            if existing_row_index and existing_row_index >= first_new_row:
+                # Row was added since the last flush and hasn't been written yet
+                to_append[existing_row_index - first_new_row] = row_data
+                print(f"🔄 Updated new entry for {title} at {company}")
+            elif existing_row_index:
+                to_update[existing_row_index] = row_data
                 print(f"🔄 Updated row {existing_row_index} for {title} at {company}")
             else:
-                sheet.append_row(row_data)
+                to_append.append(row_data)
+                row_index[key] = next_row
+                next_row += 1
                 print(f"➕ Added new entry for {title} at {company}")
 
+            done.add(email_id)
+
         except Exception as e:
             print(f"❗️ An error occurred while processing an email: {e}")
-        finally:
-            # Respect API rate limits
-            print("--- Sleeping for 5 seconds ---")
-            time.sleep(5)
 
-    mail.logout()
+        if len(to_update) + len(to_append) >= SHEETS_FLUSH_ROWS:
+            await asyncio.to_thread(flush_sheet_writes, to_update, to_append)
+            updated, added = updated + len(to_update), added + len(to_append)
+            first_new_row = next_row
+            to_update, to_append = {}, []
+
+    await asyncio.to_thread(flush_sheet_writes, to_update, to_append)
+    updated, added = updated + len(to_update), added + len(to_append)
+    print(f"\n💾 Saved {updated} updated and {added} new rows to Google Sheets.")
+
+
+async def scan_and_process_emails(days=3):
+    """Scans for unread job-related emails and updates the Google Sheet.
+
+    Fetching, Gemini extraction and sheet writes run as a pipeline connected by
+    bounded queues, so each stage works on the next email while the others are busy.
+    """
+    mail = connect_to_gmail()
+    if not mail:
+        return
+
+    _, data = mail.response("UIDVALIDITY")
+    uidvalidity = (data[0] or b"").decode()
+    last_uid = load_last_uid(uidvalidity)
+
+    query = build_recent_unseen_query(days, since_uid=last_uid)
+    status, data = mail.uid("search", None, query)
+
+    # "UID n:*" always matches the newest email, even if it is older than n
+    email_ids = [uid for uid in data[0].split() if int(uid) > (last_uid or 0)] if status == "OK" else []
+    if not email_ids:
+        print("✅ No new unread job-related emails found.")
+        mail.logout()
+        return
+
+    print(f"📨 Found {len(email_ids)} unread job-related emails to process from the last {days} days.")
+
+    q_parse = asyncio.Queue(maxsize=PARSE_QUEUE_SIZE)
+    q_write = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+    semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+    done = set()  # UIDs that were written to the sheet or deliberately skipped
+    stages = [
+        asyncio.create_task(fetcher(mail, email_ids, q_parse)),
+        asyncio.create_task(analyzer(q_parse, q_write, semaphore, done)),
+        asyncio.create_task(writer(q_write, done)),
+    ]
+    try:
+        await asyncio.gather(*stages)
+    except Exception:
+        # A dead stage would leave the others blocked on a full queue
+        for stage in stages:
+            stage.cancel()
+        raise
+
+    # Only move past UIDs below the first failure, so failed emails are searched again next run
+    failed = [int(uid) for uid in email_ids if uid not in done]
+    if failed:
+        print(f"⚠️ {len(failed)} emails could not be processed and will be retried on the next run.")
+    new_last_uid = min(failed) - 1 if failed else max(int(uid) for uid in email_ids)
+    if new_last_uid > (last_uid or 0):
+        save_last_uid(uidvalidity, new_last_uid)
+
+
+async def watch_inbox(days=3):
+    """Keeps running: scans once, then rescans whenever IMAP IDLE reports new mail."""
+    mail = None
+    retry_delay = WATCH_RETRY_DELAY
+    try:
+        while True:
+            try:
+                await scan_and_process_emails(days)
+
+                # IDLE connections time out or get dropped; open a fresh one when that happens
+                if mail is None:
+                    mail = connect_to_gmail()
+                    if not mail:
+                        raise ConnectionError("could not connect to Gmail")
+            except Exception as e:
+                # Network, Gmail or Sheets hiccups shouldn't end a long-running watch
+                print(f"❗️ Scan failed: {e}. Retrying in {retry_delay} seconds.")
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, WATCH_MAX_RETRY_DELAY)
+                continue
+            retry_delay = WATCH_RETRY_DELAY
+
+            print("👀 Waiting for new emails...")
+            try:
+                new_mail = await asyncio.to_thread(wait_for_new_mail, mail)
+            except (imaplib.IMAP4.error, OSError) as e:
+                print(f"⚠️ Lost the IDLE connection: {e}")
+                new_mail = False
+            if not new_mail:
+                close_quietly(mail)
+                mail = None
+    finally:
+        if mail:
+            close_quietly(mail)
 
 
 if __name__ == "__main__":
-    scan_and_process_emails(days=3)
+    parser = argparse.ArgumentParser(description="Track job application emails in Google Sheets.")
+    parser.add_argument("--watch", action="store_true", help="keep running and process new emails as they arrive")
+    args = parser.parse_args()
+
+    asyncio.run(watch_inbox(days=3) if args.watch else scan_and_process_emails(days=3))